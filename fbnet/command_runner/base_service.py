@@ -134,9 +134,8 @@ class ServiceTask(ServiceObj):
         return await self.loop.run_in_executor(self._executor, method, *args)
 
     async def wait(self):
-        await self._update_event.acquire()
-        await self._update_event.wait()
-        self._update_event.release()
+        async with self._update_event:
+            await self._update_event.wait()
 
     def cancel(self):
         self._task.cancel()
@@ -184,9 +183,8 @@ class ServiceTask(ServiceObj):
         """
         Notify coroutines waiting on this service
         """
-        await self._update_event.acquire()
-        self._update_event.notify_all()
-        self._update_event.release()
+        async with self._update_event:
+            self._update_event.notify_all()
 
 
 class PeriodicServiceTask(ServiceTask):
@@ -8,12 +8,14 @@
 
 import abc
 import asyncio
+import heapq
+import itertools
 import logging
 import re
 import time
 from collections import namedtuple
-from functools import wraps
-from typing import Dict, Hashable, NamedTuple, Optional, Union
+from functools import lru_cache, wraps
+from typing import Dict, List, NamedTuple, Optional, Pattern, Tuple, Union
 
 import asyncssh
 from fbnet.command_runner_asyncio.CommandRunner import ttypes
@@ -28,9 +30,58 @@ asyncssh.public_key.register_public_key_alg(b"rsa-sha2-256", asyncssh.rsa._RSAKe
 
 log = logging.getLogger("fcr.CommandSession")
 
+# 'match' is the re.Match object from the prompt search. It is taken on a copy
+# of the data around the match, so match.string is not the whole stream and its
+# positions (span(), start(), end()) are relative to that copy.
+# Use 'data' and 'matched' for the position of the match in the response.
 ResponseMatch = namedtuple("ResponseMatch", ["data", "matched", "groupdict", "match"])
 
 
+# Characters with a special meaning in a regex. ']' and '}' have no special
+# meaning unless they follow '[' or '{'
+_RE_SPECIAL_CHARS = frozenset(b".^$*+?{[\\|()")
+
+
+@lru_cache(maxsize=128)
+def _literal_pattern(regex: Pattern) -> Optional[bytes]:
+    """
+    Return the pattern string if the regex only matches that literal string,
+    e.g. a fixed prompt or delimiter. Otherwise return None
+    """
+    pattern = regex.pattern
+    if not isinstance(pattern, bytes) or regex.flags & (re.I | re.X):
+        return None
+    if any(c in _RE_SPECIAL_CHARS for c in pattern):
+        return None
+    return pattern
+
+
+# Escaped command words. Commands that miss the _compile_cmd_re cache usually
+# still share most of their words with other commands
+_escape_word = lru_cache(maxsize=1024)(re.escape)
+
+
+@lru_cache(maxsize=512)
+def _compile_cmd_re(cmd: bytes) -> Tuple[Pattern, bytes]:
+    """
+    Build the regex for matching the command echo in the output, along with
+    the sanitized command line (redundant spaces removed, newline terminated).
+    The same commands are typically sent repeatedly, so the results are cached.
+    """
+    cmd_words = cmd.split()
+
+    # Command regex in the output
+    # [SPACE]{Command string}[SPACE]
+    # The words in the command string can be separated by mulitple spaces.
+    # for e.g regex for matching 'show version' command would be
+    #    b'^\s*show\s+version\s*$'
+    # We also need to escape the words to handle characters like '|'
+    cmd_words_esc = (_escape_word(w) for w in cmd_words)
+    cmd_re = br"^\s*" + br"\s+".join(cmd_words_esc) + br"([ \t]*\n)*"
+
+    return re.compile(cmd_re, re.M), b" ".join(cmd_words) + b"\n"
+
+
 class PeerInfo(NamedTuple):
     ip: Optional[str] = None
     port: Optional[Union[int, str]] = None
@@ -40,8 +91,13 @@ class PeerInfo(NamedTuple):
 
 
 class LogAdapter(logging.LoggerAdapter):
+    def __init__(self, logger, extra):
+        super().__init__(logger, extra)
+        # The session id doesn't change, so build the prefix only once
+        self._prefix = f"[session_id={extra['session'].id}]: "
+
     def process(self, msg, kwargs):
-        return "[session_id=%s]: %s" % (self.extra["session"].id, msg), kwargs
+        return self._prefix + str(msg), kwargs
 
 
 class SessionReaperTask(PeriodicServiceTask):
@@ -70,24 +126,54 @@ class SessionReaperTask(PeriodicServiceTask):
 
     COUNTER_KEY_REAPED_ALL = "session_reaper.reaped.all"
 
-    def __init__(
-        self,
-        service: ServiceObj,
-        # pyre-fixme[9]: sessions is `Dict[Hashable, CommandSession]` but is `None`
-        sessions: Dict[Hashable, "CommandSession"] = None,
-    ) -> None:
+    # The running reaper. Sessions that stay idle after being released are
+    # handed over to it by their idle timer
+    _RUNNING: Optional["SessionReaperTask"] = None
+
+    def __init__(self, service: ServiceObj) -> None:
         super().__init__(
             service, name=self.__class__.__name__, period=self.SESSION_REAP_PERIOD_S
         )
-        self._sessions = sessions or CommandSession._ALL_SESSIONS
+        # The reap checks are scheduled on CommandSession._REAP_HEAP by the
+        # sessions themselves, so the reaper works on the global session cache
+        self._sessions: Dict[int, "CommandSession"] = CommandSession._ALL_SESSIONS
+        SessionReaperTask._RUNNING = self
 
     @classmethod
     def register_counters(cls, counter_mgr):
         counter_mgr.add_stats_counter(cls.COUNTER_KEY_REAPED_ALL, ["count"])
 
+    @staticmethod
+    def running() -> Optional["SessionReaperTask"]:
+        return SessionReaperTask._RUNNING
+
+    async def cleanup(self) -> None:
+        if SessionReaperTask._RUNNING is self:
+            SessionReaperTask._RUNNING = None
+
     def _bump_counters_for_reaped_session(self, session: "CommandSession") -> None:
         self.inc_counter(self.COUNTER_KEY_REAPED_ALL)
 
+    async def reap_session(self, session: "CommandSession", curr_time: float) -> None:
+        """
+        Close an expired session. Errors are logged rather than raised, so that
+        a failure to close one session does not hold up the others
+        """
+        if self._sessions.get(session.id) is not session:
+            # Already reaped, e.g. by both the idle timer and a sweep
+            return
+        self.logger.info(
+            f"Reap session {session.id}, "
+            f"last_access_time={session.last_access_time}, "
+            f"curr_time={curr_time}"
+        )
+        try:
+            await session.close()
+        except Exception as ex:
+            self.logger.exception(f"Error when closing session {session.id}: {ex!r}")
+        self._sessions.pop(session.id, None)
+        self._bump_counters_for_reaped_session(session)
+
     async def run(self) -> None:
         """
         A session is accessed when a command begins executing, and is accessed
@@ -96,35 +182,59 @@ class SessionReaperTask(PeriodicServiceTask):
         OR 2) it exceeds the max session time out since last accessed (this could
         happend when a command get stuck). This would prevent the thrift service
         from holding up open/stale connections to network devices.
+
+        Rather than scanning all the sessions, only the sessions that are due
+        for a check are popped from CommandSession._REAP_HEAP. Sessions that
+        are not reaped are scheduled again for the time they can next expire.
+
+        Idle sessions are normally handed over by their own timer when they
+        are released (see CommandSession._schedule_idle_close), this catches
+        the rest.
         """
         try:
+            # Reaping is a coarse periodic sweep, a single timestamp is
+            # accurate enough for all the sessions. Session access times are
+            # recorded in event loop time (see CommandSession.last_access_time)
+            curr_time = self.loop.time()
+            max_idle_timeout = self.MAX_SESSION_IDLE_TIMEOUT_S
+            max_last_access_timeout = self.MAX_SESSION_LAST_ACCESS_TIMEOUT_S
             self.logger.info(
-                f"Session reaper woke up: curr_time={time.time()}, "
+                f"Session reaper woke up: curr_time={curr_time}, "
                 f"session_count={len(self._sessions)}"
             )
-            for key in list(self._sessions.keys()):
-                if key not in self._sessions:
-                    # Since this is an async method, it's possible that the session
-                    # is closed before being reaped
+            reap_heap = CommandSession._REAP_HEAP
+            reschedule = []
+            while reap_heap and reap_heap[0][0] <= curr_time:
+                _, _, session_id = heapq.heappop(reap_heap)
+                session = self._sessions.get(session_id)
+                if session is None:
+                    # Either the check was rescheduled, or the session was closed
+                    # before being reaped
                     continue
-                session = self._sessions[key]
-                curr_time = time.time()
                 time_since_last_access = curr_time - session.last_access_time
-                idle_timeout = min(
-                    session.idle_timeout, self.MAX_SESSION_IDLE_TIMEOUT_S
-                )
-                if time_since_last_access > self.MAX_SESSION_LAST_ACCESS_TIMEOUT_S or (
+                idle_timeout = min(session.idle_timeout, max_idle_timeout)
+                if time_since_last_access > max_last_access_timeout or (
                     not session.in_use and time_since_last_access > idle_timeout
                 ):
-                    self.logger.info(
-                        f"Reap session {key}, "
-                        f"last_access_time={session.last_access_time}, "
-                        f"curr_time={curr_time}"
+                    await self.reap_session(session, curr_time)
+                else:
+                    timeout = (
+                        max_last_access_timeout if session.in_use else idle_timeout
                     )
-                    await session.close()
-                    if key in self._sessions:
-                        del self._sessions[key]
-                    self._bump_counters_for_reaped_session(session)
+                    reschedule.append((session, session.last_access_time + timeout))
+
+            # Reschedule once the due entries are all popped. A check that is due
+            # again right away (e.g. when the idle time equals the timeout) then
+            # waits for the next sweep, instead of being popped over and over
+            for session, check_time in reschedule:
+                if self._sessions.get(session.id) is session:
+                    session._schedule_reap_check(check_time)
+
+            # Drop the rescheduled entries once they dominate the heap
+            if len(reap_heap) > 2 * len(self._sessions):
+                reap_heap[:] = [entry for entry in reap_heap if entry[-1] is not None]
+                heapq.heapify(reap_heap)
+
             self.logger.info(
                 f"Session reaper finished: session_count={len(self._sessions)}"
             )
@@ -142,12 +252,16 @@ def _update_last_access_time_and_in_use(fn):
     @wraps(fn)
     async def wrapper(self, *args, **kwargs):
         self._in_use_count += 1
-        self._last_access_time = time.time()
+        self._last_access_time = self._loop.time()
+        self._cancel_idle_close()
         try:
             return await fn(self, *args, **kwargs)
         finally:
             self._in_use_count -= 1
-            self._last_access_time = time.time()
+            self._last_access_time = self._loop.time()
+            # The session may have been closed while in use
+            if not self.in_use and self.id in self._ALL_SESSIONS:
+                self._schedule_idle_close()
 
     return wrapper
 
@@ -163,7 +277,18 @@ class CommandSession(ServiceObj):
     associated with the session.
     """
 
-    _ALL_SESSIONS: Dict[Hashable, "CommandSession"] = {}
+    # Sessions keyed by the session id
+    _ALL_SESSIONS: Dict[int, "CommandSession"] = {}
+
+    # A heap of [check_time, seq, session_id] entries, used by the
+    # SessionReaperTask to find the sessions that may need to be reaped. Each
+    # session has at most one live entry. When a check is rescheduled, the old
+    # entry is invalidated in place by setting its session_id to None.
+    _REAP_HEAP: List[list] = []
+    _REAP_SEQ = itertools.count()
+
+    # Loggers keyed by (class name, vendor name, hostname)
+    _LOGGERS: Dict[Tuple[str, str, str], logging.Logger] = {}
 
     # the prompt is at the end of input. So rather then searching in the entire
     # buffer, we will only look in the trailing data
@@ -199,15 +324,63 @@ class CommandSession(ServiceObj):
         # session type, e.g., rpc base session, does not need this property)
         self._cmd_stream = None
         self._connected = False
-        self._event = asyncio.Condition(loop=self._loop)
+        self._connected_event = asyncio.Event(loop=self._loop)
 
         self.logger.info("Created key=%s", self.key)
         # Record the session in the cache
-        self._ALL_SESSIONS[self.key] = self
+        self._ALL_SESSIONS[self.id] = self
 
-        self._last_access_time: float = time.time()
+        self._last_access_time: float = self._loop.time()
         self._in_use_count: int = 0
 
+        self._reap_entry: Optional[list] = None
+        self._schedule_reap_check(self._last_access_time)
+        self._idle_handle: Optional[asyncio.TimerHandle] = None
+
+    def _schedule_reap_check(self, check_time: float) -> None:
+        """
+        Schedule the session to be checked by the SessionReaperTask at
+        check_time. This replaces any previously scheduled check
+        """
+        self._cancel_reap_check()
+        self._reap_entry = [check_time, next(self._REAP_SEQ), self.id]
+        heapq.heappush(self._REAP_HEAP, self._reap_entry)
+
+    def _cancel_reap_check(self) -> None:
+        if self._reap_entry is not None:
+            self._reap_entry[-1] = None
+            self._reap_entry = None
+
+    def _schedule_idle_close(self) -> None:
+        """
+        Reap the session once it stays idle for idle_timeout seconds. This
+        replaces any previously scheduled close. The session is closed by the
+        running SessionReaperTask, whose periodic sweep only acts as a safety
+        net for idle sessions
+        """
+        self._cancel_idle_close()
+        idle_timeout = self.idle_timeout
+        if idle_timeout is not None:
+            idle_timeout = min(
+                idle_timeout, SessionReaperTask.MAX_SESSION_IDLE_TIMEOUT_S
+            )
+            self._idle_handle = self._loop.call_later(idle_timeout, self._close_if_idle)
+
+    def _cancel_idle_close(self) -> None:
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+            self._idle_handle = None
+
+    def _close_if_idle(self) -> None:
+        self._idle_handle = None
+        reaper = SessionReaperTask.running()
+        # The handle is cancelled when the session is used again or closed, so
+        # this only guards against a session that is already being closed
+        if reaper is not None and not self.in_use and self.id in self._ALL_SESSIONS:
+            asyncio.ensure_future(
+                reaper.reap_session(self, self._loop.time()), loop=self._loop
+            )
+
     def get_session_name(self):
         return self.objname
 
@@ -215,11 +388,15 @@ class CommandSession(ServiceObj):
         return self._extra_info.get("peer")
 
     def create_logger(self):
-        logger = logging.getLogger(
-            "fcr.{klass}.{dev.vendor_name}.{dev.hostname}".format(
-                klass=self.__class__.__name__, dev=self._devinfo
-            )
+        key = (
+            self.__class__.__name__,
+            self._devinfo.vendor_name,
+            self._devinfo.hostname,
         )
+        logger = self._LOGGERS.get(key)
+        if logger is None:
+            logger = logging.getLogger("fcr.{}.{}.{}".format(*key))
+            self._LOGGERS[key] = logger
 
         return LogAdapter(logger, {"session": self})
 
@@ -279,11 +456,14 @@ class CommandSession(ServiceObj):
 
     @classmethod
     def get(cls, session_id, client_ip, client_port):
-        key = (session_id, client_ip, client_port)
-        try:
-            return cls._ALL_SESSIONS[key]
-        except KeyError as ke:
-            raise KeyError("Session not found", key) from ke
+        session = cls._ALL_SESSIONS.get(session_id)
+        # The session can only be accessed by the client that created it
+        if session is None or (session._client_ip, session._client_port) != (
+            client_ip,
+            client_port,
+        ):
+            raise KeyError("Session not found", (session_id, client_ip, client_port))
+        return session
 
     @property
     def hostname(self):
@@ -323,6 +503,9 @@ class CommandSession(ServiceObj):
 
     @property
     def last_access_time(self) -> float:
+        """
+        Last access time of the session, in event loop (monotonic) time
+        """
         return self._last_access_time
 
     @property
@@ -376,14 +559,16 @@ class CommandSession(ServiceObj):
         """
         try:
             self.logger.debug("Closing session")
-            if self.key in self._ALL_SESSIONS:
-                del self._ALL_SESSIONS[self.key]
+            self._cancel_reap_check()
+            self._cancel_idle_close()
+            self._ALL_SESSIONS.pop(self.id, None)
         finally:
             self.inc_counter("%s.closed" % self.objname)
             await self._close()
             if self._cmd_stream is not None:
                 self._cmd_stream.close()
             self._connected = False
+            self._connected_event.clear()
 
     @_update_last_access_time_and_in_use
     async def run_command(self, command, *args, **kwargs):
@@ -414,27 +599,9 @@ class CommandSession(ServiceObj):
         """
         Wait until the session is marked as connected
         """
-        await self.wait_for(lambda _: self._connected, timeout=timeout)
-
-    async def _notify(self):
-        """
-        notify a change in stream state
-        """
-        await self._event.acquire()
-        self._event.notify_all()
-        self._event.release()
-
-    async def wait_for(self, predicate, timeout=None):
-        """
-        Wait for condition to become true on the session
-        """
-        await self._event.acquire()
         await asyncio.wait_for(
-            self._event.wait_for(lambda: predicate(self)),
-            timeout=timeout,
-            loop=self._loop,
+            self._connected_event.wait(), timeout=timeout, loop=self._loop
         )
-        self._event.release()
 
 
 class CommandStreamReader(asyncio.StreamReader):
@@ -448,6 +615,9 @@ class CommandStreamReader(asyncio.StreamReader):
     QUICK_COMMAND_RUNTIME = 1
     COMMAND_DATA_TIMEOUT = 1
 
+    # Data preceding a match that is copied along with it (see readuntil_re)
+    _LOOKBEHIND_SIZE = 16
+
     def __init__(self, session, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._session = session
@@ -456,6 +626,13 @@ class CommandStreamReader(asyncio.StreamReader):
     def logger(self):
         return self._session.logger
 
+    @property
+    def buffered_size(self):
+        """
+        Number of bytes received but not read yet
+        """
+        return len(self._buffer)
+
     async def wait_for(self, predicate):
         """
         Wait for the predicate to become true on the stream. As and when new
@@ -470,12 +647,13 @@ class CommandStreamReader(asyncio.StreamReader):
         start_ts = time.time()
 
         while res is None:
-            self.logger.debug(
-                "match failed in: %d: %d: %s",
-                len(self._buffer),
-                self._limit,
-                self._buffer[-100:],
-            )
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(
+                    "match failed in: %d: %d: %s",
+                    len(self._buffer),
+                    self._limit,
+                    bytes(self._buffer[-100:]),
+                )
             self._session.inc_counter("streamreader.wait_for_retry")
 
             if len(self._buffer) > self._limit:
@@ -503,7 +681,8 @@ class CommandStreamReader(asyncio.StreamReader):
 
             res = predicate(self._buffer)
 
-        self.logger.debug("match found at: %s", res)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("match found at: %s", res)
 
         return res
 
@@ -514,34 +693,73 @@ class CommandStreamReader(asyncio.StreamReader):
     async def readuntil_re(self, regex, start=0):
         """
         Read data until a regex is matched on the input stream
+
+        The buffer is not rescanned from the start every time data is received.
+        Once a search fails, the next one starts at the beginning of the last
+        line received so far, or _MAX_PROMPT_SIZE bytes before the end of the
+        data, whichever comes first. A regex that can only match by spanning
+        more than one line as well as more than _MAX_PROMPT_SIZE bytes may
+        therefore be missed.
+
+        The returned ResponseMatch.match is taken on a copy of the data
+        starting _LOOKBEHIND_SIZE bytes before the match, its groups remain
+        valid once the data is consumed, but its positions are relative to the
+        copy. Should the regex match differently on the copy (e.g. it has a
+        longer lookbehind), the whole buffer is copied instead.
         """
-        self.logger.debug("readuntil_re: %s", regex)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("readuntil_re: %s", regex)
+
+        # Position to start the next search from. Once a search fails, only the
+        # newly received data (and the trailing line that may contain a partial
+        # prompt) needs to be scanned again, instead of the entire buffer.
+        scan_from = start
+
+        # For literal patterns a plain substring search is much cheaper than
+        # the regex search. The regex is then only used to build the match
+        literal = _literal_pattern(regex)
+
+        # The search runs on the buffer, which is manipulated in place as data
+        # is read. Once found, the match is taken again on an immutable copy of
+        # the data from a few bytes before the match, so that the match and its
+        # groups stay valid once the data is consumed. The bytes before the
+        # match let lookbehind assertions and '^' see the preceding data.
+        window_start = 0
+
+        def _search(data):
+            nonlocal scan_from, window_start
+            pos = max(scan_from, 0)
+            if literal is not None:
+                pos = data.find(literal, pos)
+                match = regex.match(data, pos) if pos >= 0 else None
+            else:
+                match = regex.search(data, pos)
+            if match is None:
+                # Patterns like '.*ogin:' can match from the start of the line
+                line_start = data.rfind(b"\n", max(scan_from, 0))
+                prompt_start = len(data) - self._session._MAX_PROMPT_SIZE
+                scan_from = max(scan_from, min(line_start, prompt_start))
+                return None
+
+            m_beg, m_end = match.span()
+            window_start = max(m_beg - self._LOOKBEHIND_SIZE, 0)
+            window = bytes(memoryview(data)[window_start:])
+            window_match = regex.match(window, m_beg - window_start)
+            if (
+                window_match is None
+                or window_match.end() + window_start != m_end
+                or window_match.groups() != match.groups()
+            ):
+                window_start = 0
+                window_match = regex.match(bytes(data), m_beg)
+            return window_match
 
         try:
-            match = await self.wait_for(lambda data: regex.search(data, start))
+            match = await self.wait_for(_search)
 
             m_beg, m_end = match.span()
-            # We are matching against the data stored stored in bytebuffer
-            # The bytebuffer is manipulated in place. After we read the data
-            # the buffer may get overwritten. The match object seems to be
-            # directly referring the data in bytebuffer. This causes a problem
-            # when we try to find the matched groups in match object.
-            #
-            # In [38]: data = bytearray(b"localhost login:")
-            #
-            # In [39]: rex = re.compile(b'(?P<login>.*((?<!Last ).ogin|.sername):)|(?P<passwd>\n.*assword:)|(?P<prompt>\n.*[%#>])|(?P<ignore>( to cli \\])|(who is on this device.\\]\r\n)|(Press R
-            #     ...: ETURN to get started\r\n))\\s*$')
-            #
-            # In [40]: m = rex.search(data)
-            #
-            # In [41]: m.groupdict()
-            # Out[41]: {'ignore': None, 'login': b'localhost login:', 'passwd': None, 'prompt': None}
-            #
-            # In [42]: data[:]=b'overwrite'
-            #
-            # In [43]: m.groupdict()
-            # Out[43]: {'ignore': None, 'login': b'overwrite', 'passwd': None, 'prompt': None}
-            #
+            m_beg += window_start
+            m_end += window_start
             groupdict = match.groupdict()
             rdata = await self.read(m_end)
             data = rdata[:m_beg]  # Data before the regex match
@@ -569,8 +787,13 @@ class CommandStreamReader(asyncio.StreamReader):
 
 class CommandStream(asyncio.StreamReaderProtocol):
 
-    # TODO: make this tweakable from configerator
-    _BUFFER_LIMIT = 100 * (2 ** 20)  # 100M
+    _BUFFER_LIMIT = Option(
+        "--stream_buffer_limit",
+        help="Max size (in bytes) of the data buffered for a session while "
+        "waiting for the command response (default: %(default)s)",
+        type=int,
+        default=100 * (2 ** 20),  # 100M
+    )
 
     def __init__(self, session, loop):
         super().__init__(
@@ -614,6 +837,17 @@ class CliCommandSession(CommandSession):
     A command session for CLI commands. Does prompt processing on the command stream.
     """
 
+    # List of chars that will be removed from the output
+    #        ' *\x08+': space* followed by backspace characters
+    #          '\x07' : BEL(bell) char
+    _WS_RE = re.compile(br".\x08|\x07")
+
+    # Newline normalization
+    #   '\r+\n' -> '\n'
+    #   '\n\r+' -> '\n'
+    #   '\r' -> '\n'     standalone \r
+    _NL_RE = re.compile(br"(\r+\n)|(\n\r+)|\r")
+
     def __init__(self, service, devinfo, options, loop):
         super().__init__(service, devinfo, options, loop)
 
@@ -660,17 +894,8 @@ class CliCommandSession(CommandSession):
 
     def _fixup_whitespace(self, output):
         # we need to sanitize the output to remove '\r' and other chars.
-        # List of chars that will be removed
-        #        ' *\x08+': space* followed by backspace characters
-        #          '\x07' : BEL(bell) char
-        output = re.sub(br".\x08|\x07", b"", output)
-
-        #
-        # We need to apply following transforms
-        #   '\r+\n' -> '\n'
-        #   '\n\r+' -> '\n'
-        #   '\r' -> '\n'     standalone \r
-        output = re.sub(br"(\r+\n)|(\n\r+)|\r", b"\n", output)
+        output = self._WS_RE.sub(b"", output)
+        output = self._NL_RE.sub(b"\n", output)
 
         return output.strip()
 
@@ -685,25 +910,21 @@ class CliCommandSession(CommandSession):
         In addition '\r\n' | '\n\r' | '\r' will be replace with '\n'
 
         """
-        cmd_words = cmd.split()
-
         # Fixup the white spaces first, as some devices are inserting backspace
         # characters in the command echo
         cmd_output = self._fixup_whitespace(resp.data)
 
-        # Command regex in the output
-        # [SPACE]{Command string}[SPACE]
-        # The words in the command string can be separated by mulitple spaces.
-        # for e.g regex for matching 'show version' command would be
-        #    b'^\s*show\s+version\s*$'
-        # We also need to escape the words to handle characters like '|'
-        cmd_words_esc = (re.escape(w) for w in cmd_words)
-        cmd_re = br"^\s*" + br"\s+".join(cmd_words_esc) + br"([ \t]*\n)*"
-
         # Now replace the 'command string' in the output with a sanitized
         # version (redundant spaces removed)
         # '  show  version  '  ==>  'show version'
-        cmd_output = re.sub(cmd_re, b" ".join(cmd_words) + b"\n", cmd_output, 1, re.M)
+        cmd_re, cmd_line = _compile_cmd_re(cmd)
+
+        # Most devices echo the command as is, followed by the output. In that
+        # case the substitution would leave the output unchanged, so skip it.
+        # The echo is only known to be clean if the next line isn't blank
+        next_char = cmd_output[len(cmd_line) : len(cmd_line) + 1]
+        if not cmd_output.startswith(cmd_line) or next_char in b" \t\n":
+            cmd_output = cmd_re.sub(cmd_line, cmd_output, 1)
 
         # Now we need to prepend the prompt to the command output. The prompt is
         # the matched part in the 'resp'
@@ -723,32 +944,37 @@ class CliCommandSession(CommandSession):
         # Ideally there should be no data on the stream. We will in any case
         # drain any stale data. This is mostly for debugging and making sure
         # that we are in sane state
-        stale_data = await self._stream_reader.drain()
-        if len(stale_data) != 0:
+        if self._stream_reader.buffered_size != 0:
+            stale_data = await self._stream_reader.drain()
             self.logger.warning("Stale data on session: %s", stale_data)
 
         output = []
 
+        # These stay the same for all the commands in a (possibly large) batch
+        get_command_info = self._devinfo.get_command_info
+        command_prompts = self._opts.get("command_prompts")
+        cmd_timeout = timeout or self._devinfo.vendor_data.cmd_timeout_sec
+        write = self._stream_writer.write
+
         commands = cmd.splitlines()
         for command in commands:
-            cmdinfo = self._devinfo.get_command_info(
-                command, self._opts.get("command_prompts")
-            )
+            cmdinfo = get_command_info(command, command_prompts)
 
             self.logger.info("RUN: %r", cmdinfo.cmd)
 
-            # Send any precmd data (e.g. \x15 to clear the commandline)
+            # Send any precmd data (e.g. \x15 to clear the commandline) along
+            # with the command, so that they go out in a single write
             if cmdinfo.precmd:
-                self._stream_writer.write(cmdinfo.precmd)
-
-            self._stream_writer.write(cmdinfo.cmd)
+                write(cmdinfo.precmd + cmdinfo.cmd)
+            else:
+                write(cmdinfo.cmd)
 
             try:
                 prompt = prompt_re or cmdinfo.prompt_re
 
                 resp = await asyncio.wait_for(
                     self._wait_response(command, prompt),
-                    timeout or self._devinfo.vendor_data.cmd_timeout_sec,
+                    cmd_timeout,
                     loop=self._loop,
                 )
                 output.append(self._format_output(command, resp))
@@ -770,11 +996,12 @@ class CliCommandSession(CommandSession):
         self._connected = True
 
         # Notify anyone waiting for session to be connected
-        asyncio.ensure_future(self._notify(), loop=self._loop)
+        self._connected_event.set()
 
     def exit_status_received(self, status):
         self.logger.info("exit status received: %s", status)
         self._connected = False
+        self._connected_event.clear()
         self._exit_status = status
 
 
@@ -786,24 +1013,54 @@ class SSHCommandClient(asyncssh.SSHClient):
     asyncssh. For now we are adding a workaround in FCR. We will save the
     connection object when we get a connection_made callback. This will be used
     to close the connection when we close the session.
+
+    A shared connection can outlive the session that created it, so the session
+    is detached from the client once the connection is set up. The client then
+    only keeps the key of a shared connection, to remove it from the connection
+    cache when it's lost.
     """
 
-    def __init__(self, session):
+    def __init__(self, session, conn_key=None):
         super().__init__()
         self._session = session
+        self._conn_key = conn_key
+        self._conn = None
 
     def connection_made(self, conn):
         super().connection_made(conn)
-        self._session.connection_made(conn)
+        self._conn = conn
+        if self._session is not None:
+            self._session.connection_made(conn)
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        if self._conn_key is not None:
+            SSHCommandSession._evict_connection(self._conn_key, self._conn)
+
+    def detach_session(self):
+        self._session = None
 
 
 class SSHCommandSession(CliCommandSession):
     TERM_TYPE = "vt100"
 
+    SHARE_SSH_CONNECTIONS = Option(
+        "--share_ssh_connections",
+        help="Share a single SSH connection between sessions to the same device, "
+        "user and port. Each session opens a new channel on the shared connection",
+        action="store_true",
+        default=False,
+    )
+
+    # Connections shared between sessions, keyed by (host, port, username,
+    # password). Maps to the connection and the number of sessions using it
+    _CONN_CACHE: Dict[Tuple, Tuple["asyncssh.SSHClientConnection", int]] = {}
+
     def __init__(self, counter_mgr, devinfo, options, loop):
         super().__init__(counter_mgr, devinfo, options, loop)
 
         self._conn = None
+        self._conn_key = None
         self._chan = None
 
     def connection_made(self, conn):
@@ -812,8 +1069,17 @@ class SSHCommandSession(CliCommandSession):
         self._extra_info["sockname"] = conn.get_extra_info("sockname")
         self._conn = conn
 
-    def _client_factory(self):
-        return SSHCommandClient(self)
+    @classmethod
+    def _evict_connection(cls, conn_key, conn):
+        """
+        Make sure a lost connection is not handed out to new sessions
+        """
+        cached = cls._CONN_CACHE.get(conn_key)
+        if cached is not None and cached[0] is conn:
+            del cls._CONN_CACHE[conn_key]
+
+    def _client_factory(self, conn_key=None):
+        return SSHCommandClient(self, conn_key)
 
     async def dest_info(self):
         ip = self._devinfo.get_ip(self._opts)
@@ -850,19 +1116,36 @@ class SSHCommandSession(CliCommandSession):
         else:
             host = ip
 
-        self.logger.info("Connecting to: %s: %d", host, port)
-
-        # known_hosts is set to None to disable the host verifications. Without
-        # this the connection setup fails for some devices
-        conn, _ = await asyncssh.create_connection(
-            self._client_factory,
-            host=host,
-            port=port,
-            username=user,
-            password=passwd,
-            client_keys=None,
-            known_hosts=None,
-        )
+        conn_key = (host, port, user, passwd) if self.SHARE_SSH_CONNECTIONS else None
+        cached = self._CONN_CACHE.get(conn_key) if conn_key is not None else None
+
+        if cached is not None:
+            conn, refcount = cached
+            self.logger.info("Reusing connection to: %s: %d", host, port)
+            self._CONN_CACHE[conn_key] = (conn, refcount + 1)
+            self._conn_key = conn_key
+            self.connection_made(conn)
+        else:
+            self.logger.info("Connecting to: %s: %d", host, port)
+
+            # known_hosts is set to None to disable the host verifications.
+            # Without this the connection setup fails for some devices
+            conn, client = await asyncssh.create_connection(
+                lambda: self._client_factory(conn_key),
+                host=host,
+                port=port,
+                username=user,
+                password=passwd,
+                client_keys=None,
+                known_hosts=None,
+            )
+            client.detach_session()
+
+            # Another session may have connected to the same destination while
+            # we were waiting. In that case we just keep our own connection
+            if conn_key is not None and conn_key not in self._CONN_CACHE:
+                self._CONN_CACHE[conn_key] = (conn, 1)
+                self._conn_key = conn_key
 
         chan, cmd_stream = await self._conn.create_session(
             lambda: CommandStream(self, self._loop),
@@ -878,4 +1161,18 @@ class SSHCommandSession(CliCommandSession):
         if self._chan is not None:
             self._chan.close()
         if self._conn is not None:
-            self._conn.close()
+            self._release_connection()
+
+    def _release_connection(self):
+        """
+        Close the connection, unless it is still being used by other sessions
+        """
+        conn, self._conn = self._conn, None
+        cached = self._CONN_CACHE.get(self._conn_key)
+        if cached is not None and cached[0] is conn:
+            refcount = cached[1] - 1
+            if refcount > 0:
+                self._CONN_CACHE[self._conn_key] = (conn, refcount)
+                return
+            del self._CONN_CACHE[self._conn_key]
+        conn.close()
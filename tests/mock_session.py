@@ -14,7 +14,6 @@ from fbnet.command_runner import command_session
 class MockCommandTransport(asyncio.Transport):
 
     _COMMAND_OUTPUTS = {
-        b"\x15": b"",
         b"en\n": b"en\n$",
         b"term width 511\n": b"term width 511\n$",
         b"term len 0\n": b"term len 0\n$",
@@ -23,6 +22,14 @@ Mock response for test1
 $""",
         b"show version\n": b"""show version
 Mock response for show version
+$""",
+        b"show  interfaces   brief\n": b"""show  interfaces   brief
+Mock response for show interfaces brief
+$""",
+        b"show blank lines\n": b"""show blank lines
+ 	
+
+Mock response for show blank lines
 $""",
         b"command timeout\n": b"""command timeout
 Mock response for command timeout""",
@@ -61,6 +68,9 @@ Test for user prompts
         self._recv_data(response, self.command_delay())
 
     def write(self, data):
+        # The clear command (^U) is sent in the same write as the command
+        if data.startswith(b"\x15"):
+            data = data[1:]
         self._run_command(data)
 
     def close(self):
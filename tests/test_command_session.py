@@ -8,9 +8,18 @@
 
 import asyncio
 import logging
+import re
 
 import mock
-from fbnet.command_runner.command_session import CommandSession
+from fbnet.command_runner.command_session import (
+    CommandSession,
+    CommandStreamReader,
+    SessionReaperTask,
+    SSHCommandSession,
+    _literal_pattern,
+    _update_last_access_time_and_in_use,
+)
+from fbnet.command_runner.options import Option
 
 from .mock_session import MockCommandSession
 from .mocks import MockService
@@ -20,6 +29,15 @@ from .testutil import AsyncTestCase, async_test
 log = logging.getLogger()
 
 
+@_update_last_access_time_and_in_use
+async def _use_session(session, event=None):
+    """
+    helper method to use the session until the event is set
+    """
+    if event is not None:
+        await event.wait()
+
+
 class CommandSessionTest(AsyncTestCase):
     def setUp(self):
         super().setUp()
@@ -40,11 +58,6 @@ class CommandSessionTest(AsyncTestCase):
             self.mock_options, handler, self.devinfo, self.options, loop=self._loop
         )
         self.session_id = self.session.id
-        self.key = (
-            self.session.id,
-            self.options["client_ip"],
-            self.options["client_port"],
-        )
 
     def tearDown(self):
         try:
@@ -71,12 +84,19 @@ class CommandSessionTest(AsyncTestCase):
 
     def test_create(self):
         self.assertFalse(self.session._connected)
-        self.assertIn(self.key, CommandSession._ALL_SESSIONS)
+        self.assertIn(self.session_id, CommandSession._ALL_SESSIONS)
 
     def test_get(self):
         q_session = self._get_session()
         self.assertEqual(self.session, q_session)
 
+    def test_get_other_client(self):
+        with self.assertRaises(KeyError):
+            CommandSession.get(self.session_id, "10.10.10.11", 1010)
+
+        with self.assertRaises(KeyError):
+            CommandSession.get(self.session_id, self.options["client_ip"], 1011)
+
     @async_test
     async def test_connect(self):
         # Session is initially not connected
@@ -195,6 +215,31 @@ class CommandSessionTest(AsyncTestCase):
         res = await self.session.run_command(b"test1\n")
         self.assertEqual(res, b"$ test1\nMock response for test1")
 
+    @async_test
+    async def test_run_command_clean_echo(self):
+        await self.session.connect()
+        await self.session.wait_until_connected()
+        await self.session.wait_prompt()
+
+        res = await self.session.run_command(b"show version\n")
+        self.assertEqual(res, b"$ show version\nMock response for show version")
+
+    @async_test
+    async def test_run_command_sanitize_echo(self):
+        await self.session.connect()
+        await self.session.wait_until_connected()
+        await self.session.wait_prompt()
+
+        # Redundant spaces are removed from the command echo
+        res = await self.session.run_command(b"show  interfaces   brief\n")
+        self.assertEqual(
+            res, b"$ show interfaces brief\nMock response for show interfaces brief"
+        )
+
+        # as well as the blank lines following it
+        res = await self.session.run_command(b"show blank lines\n")
+        self.assertEqual(res, b"$ show blank lines\nMock response for show blank lines")
+
     @async_test
     async def test_run_command_timeout_prompt(self):
 
@@ -211,3 +256,433 @@ class CommandSessionTest(AsyncTestCase):
             rexc.exception.args[1],
             b"command timeout\nMock response for command timeout",
         )
+
+
+class SessionReaperTaskTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Keep the sessions created by other tests out of the reaper's way
+        for cls, attr, value in [
+            (CommandSession, "_ALL_SESSIONS", {}),
+            (CommandSession, "_REAP_HEAP", []),
+            (SessionReaperTask, "_RUNNING", None),
+        ]:
+            patcher = mock.patch.object(cls, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.mock_options = {}
+        self.mocks = MockService(self.mock_options, self._loop)
+
+        test_device = mock.Mock(hostname="test-dev-1", console=None)
+        self.devinfo = self._run_loop(self.mocks.device_db.get(test_device))[0]
+
+        self.reaper = SessionReaperTask(self.mocks)
+        # let the initial run complete
+        self._loop.run_until_complete(asyncio.sleep(0, loop=self._loop))
+
+    def tearDown(self):
+        for session in list(CommandSession._ALL_SESSIONS.values()):
+            self._run_loop(session.close())
+        self.mocks.tearDown()
+        super().tearDown()
+
+    def _create_session(self, idle_timeout, last_access_delta, check_delta):
+        """
+        helper method to create a session that was last accessed
+        last_access_delta seconds ago, with a reap check due check_delta
+        seconds from now
+        """
+        options = {
+            "client_ip": "10.10.10.10",
+            "client_port": 1010,
+            "open_timeout": 10,
+            "idle_timeout": idle_timeout,
+        }
+        session = MockCommandSession(
+            self.mock_options, mock.Mock(), self.devinfo, options, loop=self._loop
+        )
+        now = self._loop.time()
+        session._last_access_time = now - last_access_delta
+        session._schedule_reap_check(now + check_delta)
+        return session
+
+    def _live_heap_entries(self):
+        return [e for e in CommandSession._REAP_HEAP if e[-1] is not None]
+
+    @async_test
+    async def test_reap_due_sessions(self):
+        due = self._create_session(10, 20, -10)
+        not_due = self._create_session(10, 20, 100)
+
+        await self.reaper.run()
+
+        self.assertNotIn(due.id, CommandSession._ALL_SESSIONS)
+        self.assertIn(not_due.id, CommandSession._ALL_SESSIONS)
+        self.assertEqual(self._live_heap_entries(), [not_due._reap_entry])
+
+    @async_test
+    async def test_reschedule_active_sessions(self):
+        in_use = self._create_session(10, 20, -10)
+        in_use._in_use_count = 1
+        recent = self._create_session(10, 5, -10)
+
+        await self.reaper.run()
+
+        self.assertIn(in_use.id, CommandSession._ALL_SESSIONS)
+        self.assertIn(recent.id, CommandSession._ALL_SESSIONS)
+
+        # In-use sessions are checked again once the max access timeout expires
+        self.assertEqual(
+            in_use._reap_entry[0],
+            in_use.last_access_time + self.reaper.MAX_SESSION_LAST_ACCESS_TIMEOUT_S,
+        )
+        self.assertEqual(recent._reap_entry[0], recent.last_access_time + 10)
+        self.assertCountEqual(
+            self._live_heap_entries(), [in_use._reap_entry, recent._reap_entry]
+        )
+
+    @async_test
+    async def test_reschedule_at_timeout_boundary(self):
+        session = self._create_session(10, 0, 100)
+        session._last_access_time = 990.0
+        session._schedule_reap_check(990.0)
+
+        # The session is idle for exactly idle_timeout, and is checked again on
+        # the next sweep
+        with mock.patch.object(self._loop, "time", return_value=1000.0):
+            await self.reaper.run()
+
+        self.assertIn(session.id, CommandSession._ALL_SESSIONS)
+        self.assertEqual(self._live_heap_entries(), [session._reap_entry])
+        self.assertEqual(session._reap_entry[0], 1000.0)
+
+    @async_test
+    async def test_skip_closed_sessions(self):
+        session = self._create_session(10, 20, -10)
+        entry = session._reap_entry
+
+        await session.close()
+        self.assertIsNone(entry[-1])
+
+        with mock.patch.object(self.reaper, "_bump_counters_for_reaped_session") as m:
+            await self.reaper.run()
+            m.assert_not_called()
+
+        self.assertEqual(CommandSession._REAP_HEAP, [])
+
+    @async_test
+    async def test_idle_close_after_release(self):
+        session = self._create_session(0.01, 0, 100)
+
+        with mock.patch.object(self.reaper, "_bump_counters_for_reaped_session") as m:
+            await _use_session(session)
+            self.assertIsNotNone(session._idle_handle)
+
+            await asyncio.sleep(0.05, loop=self._loop)
+            m.assert_called_once_with(session)
+
+        self.assertNotIn(session.id, CommandSession._ALL_SESSIONS)
+        self.assertIsNone(session._idle_handle)
+
+    @async_test
+    async def test_idle_close_zero_timeout(self):
+        session = self._create_session(0, 0, 100)
+
+        await _use_session(session)
+        await asyncio.sleep(0.01, loop=self._loop)
+
+        self.assertNotIn(session.id, CommandSession._ALL_SESSIONS)
+
+    @async_test
+    async def test_idle_close_cancelled_by_reuse(self):
+        session = self._create_session(0.05, 0, 100)
+
+        await _use_session(session)
+        self.assertIsNotNone(session._idle_handle)
+
+        event = asyncio.Event(loop=self._loop)
+        fut = asyncio.ensure_future(_use_session(session, event), loop=self._loop)
+        await asyncio.sleep(0.1, loop=self._loop)
+
+        # The session is not closed while in use
+        self.assertIsNone(session._idle_handle)
+        self.assertIn(session.id, CommandSession._ALL_SESSIONS)
+
+        # and the timer restarts once it's released
+        event.set()
+        await fut
+        self.assertIsNotNone(session._idle_handle)
+
+    @async_test
+    async def test_idle_close_cancelled_by_close(self):
+        session = self._create_session(0.01, 0, 100)
+
+        with mock.patch.object(self.reaper, "_bump_counters_for_reaped_session") as m:
+            await _use_session(session)
+            await session.close()
+            self.assertIsNone(session._idle_handle)
+
+            await asyncio.sleep(0.05, loop=self._loop)
+            m.assert_not_called()
+
+    @async_test
+    async def test_idle_close_and_sweep(self):
+        session = self._create_session(10, 20, -10)
+
+        with mock.patch.object(
+            session, "_close", wraps=session._close
+        ) as close, mock.patch.object(
+            self.reaper, "_bump_counters_for_reaped_session"
+        ) as bump:
+            # The sweep runs before the reap started by the idle timer
+            session._close_if_idle()
+            await self.reaper.run()
+            await asyncio.sleep(0, loop=self._loop)
+
+            close.assert_called_once_with()
+            bump.assert_called_once_with(session)
+
+    @async_test
+    async def test_no_idle_close_after_close_in_use(self):
+        session = self._create_session(10, 0, 100)
+
+        event = asyncio.Event(loop=self._loop)
+        fut = asyncio.ensure_future(_use_session(session, event), loop=self._loop)
+        await asyncio.sleep(0, loop=self._loop)
+
+        await session.close()
+        event.set()
+        await fut
+
+        self.assertIsNone(session._idle_handle)
+
+    @async_test
+    async def test_reap_session_close_error(self):
+        session = self._create_session(10, 20, -10)
+
+        with mock.patch.object(
+            session, "_close", side_effect=RuntimeError("close failed")
+        ), mock.patch.object(self.reaper, "_bump_counters_for_reaped_session") as m:
+            await self.reaper.reap_session(session, self._loop.time())
+            m.assert_called_once_with(session)
+
+        self.assertNotIn(session.id, CommandSession._ALL_SESSIONS)
+
+
+class SSHCommandSessionTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+
+        patcher = mock.patch.object(SSHCommandSession, "_CONN_CACHE", {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch(
+            "fbnet.command_runner.command_session.asyncssh.create_connection",
+            side_effect=self._create_connection,
+        )
+        self.create_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clients = []
+
+        self.mocks = MockService({}, self._loop)
+        Option.config.share_ssh_connections = True
+
+        test_device = mock.Mock(hostname="test-dev-1", console=None)
+        self.devinfo = self._run_loop(self.mocks.device_db.get(test_device))[0]
+
+    def tearDown(self):
+        for session in list(CommandSession._ALL_SESSIONS.values()):
+            self._run_loop(session.close())
+        self.mocks.tearDown()
+        super().tearDown()
+
+    async def _create_connection(self, client_factory, **kwargs):
+        """
+        mock for asyncssh.create_connection
+        """
+
+        async def create_session(*args, **kwargs):
+            return mock.Mock(), mock.Mock()
+
+        conn = mock.Mock(create_session=create_session)
+        client = client_factory()
+        client.connection_made(conn)
+        self.clients.append(client)
+        return conn, client
+
+    async def _connect_session(self):
+        options = {
+            "client_ip": "10.10.10.10",
+            "client_port": 1010,
+            "ip_address": "10.1.1.1",
+        }
+        session = SSHCommandSession(self.mocks, self.devinfo, options, self._loop)
+        await session.connect()
+        return session
+
+    @async_test
+    async def test_reuse_connection(self):
+        session1 = await self._connect_session()
+        session2 = await self._connect_session()
+
+        self.assertEqual(self.create_connection.call_count, 1)
+        self.assertIs(session1._conn, session2._conn)
+        self.assertEqual(
+            list(SSHCommandSession._CONN_CACHE.values()), [(session1._conn, 2)]
+        )
+        # The connection does not keep the session alive
+        self.assertIsNone(self.clients[0]._session)
+
+    @async_test
+    async def test_no_sharing(self):
+        Option.config.share_ssh_connections = False
+
+        session1 = await self._connect_session()
+        session2 = await self._connect_session()
+
+        self.assertEqual(self.create_connection.call_count, 2)
+        self.assertIsNot(session1._conn, session2._conn)
+        self.assertEqual(SSHCommandSession._CONN_CACHE, {})
+
+    @async_test
+    async def test_release_connection(self):
+        session1 = await self._connect_session()
+        session2 = await self._connect_session()
+        conn = session1._conn
+
+        # Only the last session closes the connection
+        await session1.close()
+        conn.close.assert_not_called()
+        self.assertEqual(list(SSHCommandSession._CONN_CACHE.values()), [(conn, 1)])
+
+        await session2.close()
+        conn.close.assert_called_once_with()
+        self.assertEqual(SSHCommandSession._CONN_CACHE, {})
+
+    @async_test
+    async def test_evict_lost_connection(self):
+        session1 = await self._connect_session()
+        conn = session1._conn
+
+        self.clients[0].connection_lost(None)
+        self.assertEqual(SSHCommandSession._CONN_CACHE, {})
+
+        # New sessions get a new connection
+        session2 = await self._connect_session()
+        self.assertEqual(self.create_connection.call_count, 2)
+        self.assertIsNot(session2._conn, conn)
+
+        # Closing the session on the lost connection leaves the new one alone
+        await session1.close()
+        conn.close.assert_called_once_with()
+        self.assertEqual(
+            list(SSHCommandSession._CONN_CACHE.values()), [(session2._conn, 1)]
+        )
+
+
+class CommandStreamReaderTest(AsyncTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.session = mock.Mock(
+            logger=log, _MAX_PROMPT_SIZE=CommandSession._MAX_PROMPT_SIZE
+        )
+        self.reader = CommandStreamReader(self.session, loop=self._loop)
+
+    async def _readuntil_re(self, regex, chunks, start=0):
+        """
+        helper method to feed the data in chunks while waiting for a match
+        """
+        fut = asyncio.ensure_future(
+            self.reader.readuntil_re(regex, start), loop=self._loop
+        )
+        for chunk in chunks:
+            self.reader.feed_data(chunk)
+            # let the reader search the partial data
+            await asyncio.sleep(0, loop=self._loop)
+            await asyncio.sleep(0, loop=self._loop)
+        return await asyncio.wait_for(fut, 1, loop=self._loop)
+
+    @async_test
+    async def test_readuntil_re_split_prompt(self):
+        prompt_re = re.compile(rb"(?P<prompt>\n[\w\-]+[#>])\s*$")
+        chunks = [b"show version\n", b"x" * 300, b"\nrout", b"er-1", b"#"]
+
+        res = await self._readuntil_re(prompt_re, chunks, -100)
+
+        self.assertEqual(res.data, b"show version\n" + b"x" * 300)
+        self.assertEqual(res.matched, b"\nrouter-1#")
+        self.assertEqual(res.groupdict, {"prompt": b"\nrouter-1#"})
+        self.assertEqual(self.reader.buffered_size, 0)
+
+    @async_test
+    async def test_readuntil_re_split_long_line(self):
+        # The match starts more than _MAX_PROMPT_SIZE bytes before the end
+        login_re = re.compile(rb"(?P<login>.*ogin:)")
+        chunks = [b"banner\n", b"x" * 150, b" lo", b"gin", b":"]
+
+        res = await self._readuntil_re(login_re, chunks)
+
+        self.assertEqual(res.data, b"banner\n")
+        self.assertEqual(res.matched, b"x" * 150 + b" login:")
+        self.assertEqual(res.groupdict, {"login": b"x" * 150 + b" login:"})
+
+    def test_literal_pattern(self):
+        self.assertEqual(_literal_pattern(re.compile(b"]]>]]>")), b"]]>]]>")
+        self.assertEqual(_literal_pattern(re.compile(b"\n$ ")), None)
+        self.assertEqual(_literal_pattern(re.compile(b"x.z")), None)
+        self.assertEqual(_literal_pattern(re.compile(b"xyz", re.I)), None)
+        self.assertEqual(_literal_pattern(re.compile("xyz")), None)
+
+    @async_test
+    async def test_readuntil_re_literal(self):
+        delim_re = re.compile(b"]]>]]>")
+        chunks = [b"<rpc-reply>]]>]]", b"</rpc-reply>\n]]", b">]", b"]>"]
+
+        res = await self._readuntil_re(delim_re, chunks)
+
+        self.assertEqual(res.data, b"<rpc-reply>]]>]]</rpc-reply>\n")
+        self.assertEqual(res.matched, b"]]>]]>")
+
+    @async_test
+    async def test_readuntil_re_special_chars(self):
+        # The pattern is not a literal string, and must be matched as a regex
+        special_re = re.compile(b"x.z")
+        chunks = [b"abc x", b"y", b"z"]
+
+        res = await self._readuntil_re(special_re, chunks)
+
+        self.assertEqual(res.data, b"abc ")
+        self.assertEqual(res.matched, b"xyz")
+
+    @async_test
+    async def test_readuntil_re_match_after_read(self):
+        prompt_re = re.compile(rb"(?P<prompt>\n[\w\-]+[#>])\s*$")
+        chunks = [b"x" * 300, b"\nrouter-1#"]
+
+        res = await self._readuntil_re(prompt_re, chunks)
+
+        # The buffer is reused for the data received after the match
+        self.reader.feed_data(b"\nmore data")
+        await self.reader.read(5)
+
+        self.assertEqual(res.match.groupdict(), {"prompt": b"\nrouter-1#"})
+        self.assertEqual(res.match.group(), res.matched)
+        self.assertEqual(res.groupdict, res.match.groupdict())
+        self.assertEqual(self.reader.buffered_size, 5)
+
+    @async_test
+    async def test_readuntil_re_long_lookbehind(self):
+        # The lookbehind reaches further back than the copied window
+        marker = b"=" * (CommandStreamReader._LOOKBEHIND_SIZE * 2)
+        prompt_re = re.compile(rb"(?<=" + marker + rb")(?P<prompt>#)")
+        chunks = [b"x#", marker, b"#"]
+
+        res = await self._readuntil_re(prompt_re, chunks)
+
+        self.assertEqual(res.data, b"x#" + marker)
+        self.assertEqual(res.matched, b"#")
+        self.assertEqual(res.groupdict, {"prompt": b"#"})